@@ -1,47 +1,29 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
-import sys
+import logging
 import re
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
 
 # Import the core logic functions
 from core_logic import (
-    extract_thread_id_from_url,
-    get_thread_messages,
-    filter_image_posts,
-    get_post_data,
+    collect_thread_posts,
+    get_all_post_data,
     generate_csv,
-    generate_markdown_output
+    prepare_ranking,
+    RANK_EMOJI,
+    YIELD_EVERY
 )
 
-def setup_commands(bot):
-    """Set up all slash commands for the bot."""
-    
-    @bot.tree.command(name="photochallenge", description="Photo challenge analysis and help commands.")
-    @app_commands.describe(
-        operation="Choose the operation to perform"
-    )
-    @app_commands.choices(operation=[
-        app_commands.Choice(name="full", value="full"),
-        app_commands.Choice(name="short", value="short"),
-        app_commands.Choice(name="help", value="help")
-    ])
-    async def photochallenge_command(interaction: discord.Interaction, operation: str):
-        """Main photo challenge command with operations."""
-        await interaction.response.defer(thinking=True, ephemeral=True)
-        
-        if operation == "help":
-            await handle_help_command(interaction)
-        elif operation == "full":
-            await handle_full_analysis(interaction)
-        elif operation == "short":
-            await handle_short_analysis(interaction)
-        else:
-            await interaction.followup.send("⚠️ Invalid operation. Use 'full' for complete analysis, 'short' for summary only, or 'help' for information.", ephemeral=True)
+log = logging.getLogger(__name__)
 
-async def handle_help_command(interaction: discord.Interaction):
-    """Handle the help command."""
-    help_markdown = """**🤖 Photo Challenge Counter Bot Help**
+# Thread-name sanitization for CSV filenames
+_RE_FN_STRIP = re.compile(r'[^\w\s-]')
+_RE_FN_WS = re.compile(r'\s+')
+
+# Static help text sent by /photochallenge help
+_HELP_MARKDOWN = """**🤖 Photo Challenge Counter Bot Help**
 
 This bot analyzes Discord threads to identify image posts and count reactions (excluding self-reactions) to determine top submissions.
 
@@ -72,267 +54,274 @@ This bot analyzes Discord threads to identify image posts and count reactions (e
 
 *Note: The bot needs read access to the thread and permission to send you DMs.*
 """
+
+# Image posts of fetched threads keyed by (thread_id, last_message_id), oldest entries evicted first
+_MSG_CACHE = OrderedDict()
+_MSG_CACHE_MAX_ENTRIES = 32
+
+def invalidate_thread_cache(thread_id):
+    """Drops any cached image posts for a thread."""
+    for key in [k for k in _MSG_CACHE if k[0] == thread_id]:
+        del _MSG_CACHE[key]
+
+async def get_cached_thread_posts(channel, client):
+    """Returns (image_posts, processed_data) for the thread, reusing its image posts while no new message has been posted.
+
+    image_posts is None if the thread history could not be fetched.
+    """
+    thread_id = channel.id
+    last_message_id = getattr(channel, 'last_message_id', None)
+    key = (thread_id, last_message_id)
+
+    if last_message_id is not None and key in _MSG_CACHE:
+        _MSG_CACHE.move_to_end(key)
+        log.info("Reusing cached image posts for thread %s.", thread_id)
+        image_posts = _MSG_CACHE[key]
+        return image_posts, await get_all_post_data(image_posts)
+
+    invalidate_thread_cache(thread_id)
+    image_posts, processed_data = await collect_thread_posts(thread_id, client)
+
+    if image_posts is not None and last_message_id is not None:
+        _MSG_CACHE[key] = image_posts
+        if len(_MSG_CACHE) > _MSG_CACHE_MAX_ENTRIES:
+            _MSG_CACHE.popitem(last=False)
+    return image_posts, processed_data
+
+def setup_commands(bot):
+    """Set up all slash commands for the bot."""
     
+    @bot.tree.command(name="photochallenge", description="Photo challenge analysis and help commands.")
+    @app_commands.describe(
+        operation="Choose the operation to perform"
+    )
+    @app_commands.choices(operation=[
+        app_commands.Choice(name="full", value="full"),
+        app_commands.Choice(name="short", value="short"),
+        app_commands.Choice(name="help", value="help")
+    ])
+    async def photochallenge_command(interaction: discord.Interaction, operation: str):
+        """Main photo challenge command with operations."""
+        await interaction.response.defer(thinking=True, ephemeral=True)
+        
+        if operation == "help":
+            await handle_help_command(interaction)
+        elif operation == "full":
+            await handle_full_analysis(interaction)
+        elif operation == "short":
+            await handle_short_analysis(interaction)
+        else:
+            await interaction.followup.send("⚠️ Invalid operation. Use 'full' for complete analysis, 'short' for summary only, or 'help' for information.", ephemeral=True)
+
+async def handle_help_command(interaction: discord.Interaction):
+    """Handle the help command."""
     try:
-        await interaction.user.send(help_markdown)
-        print(f"LOG: Sent help DM to user {interaction.user.name}.", file=sys.stderr, flush=True)
+        await interaction.user.send(_HELP_MARKDOWN)
+        log.info("Sent help DM to user %s.", interaction.user.name)
         await interaction.followup.send("✅ Help guide sent to your Direct Messages.", ephemeral=True)
     except discord.Forbidden:
-        print(f"WARNING: Failed to send help DM to {interaction.user.name}. User likely disabled DMs.", file=sys.stderr, flush=True)
+        log.warning("Failed to send help DM to %s. User likely disabled DMs.", interaction.user.name)
         await interaction.followup.send("⚠️ I cannot send you a DM. Please check your privacy settings or enable DMs from this server.", ephemeral=True)
     except Exception as e:
-        print(f"ERROR: Unexpected error sending help DM to {interaction.user.name}. Details: {e}", file=sys.stderr, flush=True)
+        log.error("Unexpected error sending help DM to %s. Details: %s", interaction.user.name, e)
         await interaction.followup.send("⚠️ An unexpected error occurred while sending the DM.", ephemeral=True)
 
-async def handle_full_analysis(interaction: discord.Interaction):
-    """Handle the full analysis command."""
-    
+@dataclass
+class AnalysisResult:
+    """Processed posts and summary totals for one analyzed thread."""
+    thread_id: int
+    processed_data: list
+    total_posts: int
+    total_reactions: int
+    unique_reactors: int
+
+async def _collect_analysis(interaction: discord.Interaction, analysis_name: str, progress_message: str):
+    """Fetch, filter and aggregate the current thread. Returns None after notifying the user on failure."""
+
     # Check if command is run in a guild
     if not interaction.guild:
-        print("WARNING: Command executed outside of a guild context (DM?). Ignoring.", file=sys.stderr, flush=True)
+        log.warning("Command executed outside of a guild context (DM?). Ignoring.")
         await interaction.followup.send("This command must be run inside a Discord server channel.", ephemeral=True)
-        return
+        return None
     
     # Use the current thread/channel for analysis
     thread_id = interaction.channel.id
-    print(f"LOG: Full analysis command received from {interaction.user.name} for thread ID: {thread_id}", file=sys.stderr, flush=True)
+    log.info("%s command received from %s for thread ID: %s", analysis_name, interaction.user.name, thread_id)
         
-    await interaction.followup.send(f"🔍 Analyzing this thread for photo submissions... This may take a moment.")
+    await interaction.followup.send(progress_message)
 
-    # 1. Fetch Data
-    all_messages = await get_thread_messages(thread_id, interaction.client) 
+    # 1-2. Fetch Data, then Filter and Process (image posts are processed while history pages stream in)
+    image_posts, processed_data = await get_cached_thread_posts(interaction.channel, interaction.client)
     
-    if not all_messages:
-        print(f"WARNING: No messages were returned for thread {thread_id}. Terminating analysis.", file=sys.stderr, flush=True)
+    if image_posts is None:
+        log.warning("Message history could not be fetched for thread %s. Terminating analysis.", thread_id)
         await interaction.followup.send("⚠️ Could not fetch any messages. Check thread permissions.", ephemeral=True)
-        return
+        return None
 
-    # 2. Filter and Process
-    image_messages = filter_image_posts(all_messages)
-    print(f"LOG: Found {len(image_messages)} image posts to process.", file=sys.stderr, flush=True)
+    log.info("Processed %d image posts.", len(processed_data))
     
-    if len(image_messages) == 0:
+    if len(processed_data) == 0:
         await interaction.followup.send("📷 No image posts found in this thread.", ephemeral=True)
-        return
-        
-    processed_data = [await get_post_data(msg) for msg in image_messages]
+        return None
     
     # 3. Calculate Summary Metrics
-    total_image_posts_count = len(processed_data)
-    total_thread_reactions = 0
-    unique_reactors_ids = set()
-
-    for message in image_messages:
-        author_id = message.author.id
-        for reaction in message.reactions:
-            async for user in reaction.users():
-                if user.id != author_id:
-                    total_thread_reactions += 1
-                    unique_reactors_ids.add(user.id)
-    total_unique_reactors_count = len(unique_reactors_ids)
-    print(f"LOG: Analysis complete. Total reactions: {total_thread_reactions}, Unique reactors: {total_unique_reactors_count}", file=sys.stderr, flush=True)
-
-    # 4. Generate CSV (Save to temporary storage)
-    thread_name = interaction.channel.name if hasattr(interaction.channel, 'name') else f"Thread_{thread_id}"
-    sanitized_name = re.sub(r'[^\w\s-]', '', thread_name)
-    sanitized_name = re.sub(r'\s+', '_', sanitized_name).strip()
-    csv_filename = f"{sanitized_name}_results.csv" if sanitized_name else "image_posts_reactions_results.csv"
-    csv_filepath = generate_csv(processed_data, filename=csv_filename)
-    
-    # 5. Generate Markdown Outputs
-    markdown_output_full = generate_markdown_output(
-        processed_data, 5, total_image_posts_count, total_thread_reactions, total_unique_reactors_count, True
+    # Reactor sets were collected by get_post_data
+    total_thread_reactions = sum(post.reactions for post in processed_data)
+    unique_reactors_ids = set().union(*(post.reactor_ids for post in processed_data))
+    result = AnalysisResult(
+        thread_id=thread_id,
+        processed_data=processed_data,
+        total_posts=len(processed_data),
+        total_reactions=total_thread_reactions,
+        unique_reactors=len(unique_reactors_ids),
     )
-    markdown_output_short = generate_markdown_output(
-        processed_data, 5, total_image_posts_count, total_thread_reactions, total_unique_reactors_count, False
+    log.info("%s complete. Total reactions: %s, Unique reactors: %s", analysis_name, result.total_reactions, result.unique_reactors)
+    return result
+
+async def handle_full_analysis(interaction: discord.Interaction):
+    """Handle the full analysis command."""
+    result = await _collect_analysis(
+        interaction, "Full analysis", "🔍 Analyzing this thread for photo submissions... This may take a moment."
     )
+    if result is None:
+        return
+    processed_data = result.processed_data
 
-    # 6. Generate enhanced report with vote counts per rank
-    enhanced_report = generate_enhanced_ranking(processed_data, total_image_posts_count, total_thread_reactions, total_unique_reactors_count)
+    # 4. Generate CSV (in memory, attached directly to the DM)
+    thread_name = interaction.channel.name if hasattr(interaction.channel, 'name') else f"Thread_{result.thread_id}"
+    sanitized_name = _RE_FN_STRIP.sub('', thread_name)
+    sanitized_name = _RE_FN_WS.sub('_', sanitized_name).strip()
+    csv_filename = f"{sanitized_name}_results.csv" if sanitized_name else "image_posts_reactions_results.csv"
+    # Build the CSV on a worker thread so the event loop stays free while the report is built
+    csv_task = asyncio.create_task(asyncio.to_thread(generate_csv, processed_data, filename=csv_filename))
+    await asyncio.sleep(0)  # Let the task hand generate_csv to the worker before the report is built
     
-    # 7. Send results via DM only (2 messages total)
+    # 5. Generate enhanced report with vote counts per rank
+    enhanced_report = await generate_enhanced_ranking(processed_data, result.total_posts, result.total_reactions, result.unique_reactors)
+    csv_file = await csv_task
+    
+    # 6. Send results via DM only (2 messages total)
     try:
         # Send CSV file first
-        if csv_filepath:
+        if csv_file:
             await interaction.user.send(
                 "📊 **Photo Challenge Analysis Complete!**\n\nHere's your detailed analysis with CSV data:",
-                file=discord.File(csv_filepath),
+                file=csv_file,
             )
-            print("LOG: CSV file sent via DM.", file=sys.stderr, flush=True)
+            log.info("CSV file sent via DM.")
         else:
              await interaction.user.send(
                 "📊 **Photo Challenge Analysis Complete!**\n\nHere's your detailed analysis (CSV generation failed):",
             )
 
-        # Send enhanced ranking report with vote counts per rank
-        if len(enhanced_report) > 2000:
-            parts = split_message(enhanced_report, 2000)
-            for part in parts:
-                await interaction.user.send(part)
-        else:
-            await interaction.user.send(enhanced_report)
+        # Send enhanced ranking report with vote counts per rank.
+        # Parts share one DM channel, so they are sent in order rather than gathered.
+        for part in await split_message(enhanced_report, 2000):
+            await interaction.user.send(part)
 
-        print("LOG: Complete analysis sent via DM.", file=sys.stderr, flush=True)
+        log.info("Complete analysis sent via DM.")
         await interaction.followup.send("✅ Analysis complete! Results sent to your DMs.", ephemeral=True)
     except Exception as e:
-        print(f"ERROR: Failed to send DM to user {interaction.user.name}. Check if user allows DMs from this guild. Details: {e}", file=sys.stderr, flush=True)
+        log.error("Failed to send DM to user %s. Check if user allows DMs from this guild. Details: %s", interaction.user.name, e)
         await interaction.followup.send(f"⚠️ Could not send analysis results to your DMs. Check your privacy settings and ensure you allow DMs from this server. Error: {e}", ephemeral=True)
 
 async def handle_short_analysis(interaction: discord.Interaction):
     """Handle the short analysis command - summary only without names."""
-    
-    # Check if command is run in a guild
-    if not interaction.guild:
-        print("WARNING: Command executed outside of a guild context (DM?). Ignoring.", file=sys.stderr, flush=True)
-        await interaction.followup.send("This command must be run inside a Discord server channel.", ephemeral=True)
-        return
-    
-    # Use the current thread/channel for analysis
-    thread_id = interaction.channel.id
-    print(f"LOG: Short analysis command received from {interaction.user.name} for thread ID: {thread_id}", file=sys.stderr, flush=True)
-        
-    await interaction.followup.send(f"🔍 Analyzing this thread for photo submission summary... This may take a moment.")
-
-    # 1. Fetch Data
-    all_messages = await get_thread_messages(thread_id, interaction.client) 
-    
-    if not all_messages:
-        print(f"WARNING: No messages were returned for thread {thread_id}. Terminating analysis.", file=sys.stderr, flush=True)
-        await interaction.followup.send("⚠️ Could not fetch any messages. Check thread permissions.", ephemeral=True)
-        return
-
-    # 2. Filter and Process
-    image_messages = filter_image_posts(all_messages)
-    print(f"LOG: Found {len(image_messages)} image posts to process.", file=sys.stderr, flush=True)
-    
-    if len(image_messages) == 0:
-        await interaction.followup.send("📷 No image posts found in this thread.", ephemeral=True)
+    result = await _collect_analysis(
+        interaction, "Short analysis", "🔍 Analyzing this thread for photo submission summary... This may take a moment."
+    )
+    if result is None:
         return
-        
-    processed_data = [await get_post_data(msg) for msg in image_messages]
-    
-    # 3. Calculate Summary Metrics
-    total_image_posts_count = len(processed_data)
-    total_thread_reactions = 0
-    unique_reactors_ids = set()
-
-    for message in image_messages:
-        author_id = message.author.id
-        for reaction in message.reactions:
-            async for user in reaction.users():
-                if user.id != author_id:
-                    total_thread_reactions += 1
-                    unique_reactors_ids.add(user.id)
-    total_unique_reactors_count = len(unique_reactors_ids)
-    print(f"LOG: Short analysis complete. Total reactions: {total_thread_reactions}, Unique reactors: {total_unique_reactors_count}", file=sys.stderr, flush=True)
 
     # 4. Generate summary-only output (no names, no rankings)
     summary_only = f"""🏆 **Photo Challenge Summary** 🏆
 
 📊 **Statistics:**
-• Total photos submitted: `{total_image_posts_count}`
-• Total votes (excluding authors): `{total_thread_reactions}`
-• Unique voters: `{total_unique_reactors_count}`
+• Total photos submitted: `{result.total_posts}`
+• Total votes (excluding authors): `{result.total_reactions}`
+• Unique voters: `{result.unique_reactors}`
 
 📷 Analysis complete for this thread."""
 
     # 5. Send summary via DM
     try:
         await interaction.user.send(summary_only)
-        print("LOG: Summary-only analysis sent via DM.", file=sys.stderr, flush=True)
+        log.info("Summary-only analysis sent via DM.")
         await interaction.followup.send("✅ Summary complete! Results sent to your DMs.", ephemeral=True)
     except Exception as e:
-        print(f"ERROR: Failed to send DM to user {interaction.user.name}. Check if user allows DMs from this guild. Details: {e}", file=sys.stderr, flush=True)
+        log.error("Failed to send DM to user %s. Check if user allows DMs from this guild. Details: %s", interaction.user.name, e)
         await interaction.followup.send(f"⚠️ Could not send summary to your DMs. Check your privacy settings and ensure you allow DMs from this server. Error: {e}", ephemeral=True)
 
-def generate_enhanced_ranking(data, total_image_posts_count, total_thread_reactions, total_unique_reactors_count):
+async def generate_enhanced_ranking(data, total_image_posts_count, total_thread_reactions, total_unique_reactors_count):
     """Generates enhanced ranking report with vote counts per rank, no image links."""
-    markdown = "🏆 **Photo Challenge Results** 🏆\n\n"
-    markdown += f"📊 **Summary:**\n"
-    markdown += f"• Total photos: `{total_image_posts_count}`\n"
-    markdown += f"• Total votes (excluding authors): `{total_thread_reactions}`\n"
-    markdown += f"• Unique voters: `{total_unique_reactors_count}`\n\n"
+    # Collect every line in one flat list and join once at the end
+    lines = [
+        "🏆 **Photo Challenge Results** 🏆",
+        "",
+        "📊 **Summary:**",
+        f"• Total photos: `{total_image_posts_count}`",
+        f"• Total votes (excluding authors): `{total_thread_reactions}`",
+        f"• Unique voters: `{total_unique_reactors_count}`",
+        "",
+    ]
     
-    if not data or all(d['reactions'] == 0 for d in data):
-        markdown += "📷 No posts found with external votes to display."
-        return markdown
+    if not data or all(d.reactions == 0 for d in data):
+        lines.append("📷 No posts found with external votes to display.")
+        return "\n".join(lines)
     
-    markdown += f"🥇 **Top {min(5, len([d for d in data if d['reactions'] > 0]))} Image Posts:**\n\n"
-
-    sorted_data = sorted(data, key=lambda x: x["reactions"], reverse=True)
-    grouped_posts = {}
-    for post in sorted_data:
-        reactions = post['reactions']
-        if reactions > 0:  # Only show posts with votes
-            if reactions not in grouped_posts:
-                grouped_posts[reactions] = []
-            grouped_posts[reactions].append(post)
+    lines.append(f"🥇 **Top {min(len(RANK_EMOJI), sum(1 for d in data if d.reactions > 0))} Image Posts:**")
+    lines.append("")
 
-    if not grouped_posts:
-        markdown += "No posts found with external votes to display."
-        return markdown
-
-    sorted_groups = sorted(grouped_posts.keys(), reverse=True)
-
-    current_rank = 1
-    output_lines = []
-
-    for reactions in sorted_groups:
-        if current_rank > 5:  # Limit to top 5
-            break
-
-        posts_in_group = grouped_posts[reactions]
-        
-        # Determine rank emoji
-        rank_emoji = "🥇" if current_rank == 1 else "🥈" if current_rank == 2 else "🥉" if current_rank == 3 else f"{current_rank}️⃣"
+    for current_rank, (reactions, posts_in_group) in enumerate(await prepare_ranking(data), 1):
+        # Determine rank emoji (prepare_ranking returns one group per RANK_EMOJI entry)
+        rank_emoji = RANK_EMOJI[current_rank - 1]
         
         # Start a new rank entry with vote count
-        group_lines = []
-        group_lines.append(f"{rank_emoji} **Rank {current_rank}** (`{reactions}` votes)")
+        lines.append(f"{rank_emoji} **Rank {current_rank}** (`{reactions}` votes)")
         
         for post in posts_in_group:
             # Post link and author
-            group_lines.append(f"   📸 **[{post['author']}]({post['post_link']})**")
+            lines.append(f"   📸 **[{post.author}]({post.post_link})**")
             
             # Include individual reaction emojis
-            reactions_str = ""
-            if post['individual_reactions']:
-                reactions_emojis = [r['emoji'] for r in post['individual_reactions']]
-                reactions_str = " " + " ".join(reactions_emojis)
+            reactions_str = "".join(" " + r['emoji'] for r in post.individual_reactions)
             
-            group_lines.append(f"      ⭐ {post['reactions']} votes{reactions_str}")
+            lines.append(f"      ⭐ {post.reactions} votes{reactions_str}")
 
-        output_lines.extend(group_lines)
-        output_lines.append("")  # Add spacing between ranks
-        current_rank += 1
+        lines.append("")  # Add spacing between ranks
         
-    return markdown + "\n".join(output_lines).rstrip()
+    return "\n".join(lines).rstrip()
 
-def split_message(message: str, max_length: int = 2000):
+async def split_message(message: str, max_length: int = 2000):
     """Split a message into chunks that fit Discord's character limit."""
     if len(message) <= max_length:
         return [message]
     
     parts = []
-    current_part = ""
-    lines = message.split('\n')
+    # Accumulate lines in a list and track the length separately
+    buf = []
+    buf_len = 0
     
-    for line in lines:
-        # If adding this line would exceed the limit
-        if len(current_part) + len(line) + 1 > max_length:
-            if current_part:
-                parts.append(current_part.strip())
-                current_part = line + '\n'
-            else:
-                # Single line is too long, split it further
-                while len(line) > max_length:
-                    parts.append(line[:max_length])
-                    line = line[max_length:]
-                current_part = line + '\n' if line else ""
-        else:
-            current_part += line + '\n'
+    for i, line in enumerate(message.split('\n'), 1):
+        if i % YIELD_EVERY == 0:
+            await asyncio.sleep(0)  # Let heartbeats and other handlers run on very long reports
+        # If adding this line would exceed the limit, flush the current part
+        if buf and buf_len + len(line) + 1 > max_length:
+            part = ''.join(buf).strip()
+            if part:
+                parts.append(part)
+            buf = []
+            buf_len = 0
+        # Single line is too long, split it further
+        while len(line) > max_length:
+            parts.append(line[:max_length])
+            line = line[max_length:]
+        buf.append(line)
+        buf.append('\n')
+        buf_len += len(line) + 1
     
-    if current_part.strip():
-        parts.append(current_part.strip())
+    part = ''.join(buf).strip()
+    if part:
+        parts.append(part)
     
     return parts
@@ -1,187 +1,295 @@
 import discord
+import asyncio
 import csv
-import re
-import sys
+import heapq
+import io
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
 from datetime import datetime
 
+log = logging.getLogger(__name__)
+
+@dataclass(slots=True)
+class PostData:
+    """Extracted details and non-author vote counts for one image post."""
+    post_link: str
+    image_links: list
+    posted_at: datetime
+    author: str
+    reactions: int
+    individual_reactions: list
+    reactor_ids: set
+
+# Caps in-flight Discord REST calls so concurrent analysis doesn't trip rate limits
+DEFAULT_MAX_CONCURRENCY = 10
+
+def _read_max_concurrency():
+    """Parses MAX_CONCURRENCY from the environment, falling back to the default on a bad value."""
+    raw = os.environ.get('MAX_CONCURRENCY')
+    if raw is None:
+        return DEFAULT_MAX_CONCURRENCY
+    try:
+        return max(1, int(raw))
+    except ValueError:
+        log.warning("Ignoring non-integer MAX_CONCURRENCY=%r; using %d.", raw, DEFAULT_MAX_CONCURRENCY)
+        return DEFAULT_MAX_CONCURRENCY
+
+MAX_CONCURRENCY = _read_max_concurrency()
+DISCORD_API_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Threads resolved through fetch_channel, keyed by id -> (fetched_at, thread)
+_THREAD_CACHE = {}
+THREAD_CACHE_TTL_SECONDS = 300
+
+# Threads longer than one history page are fetched as up to this many concurrent time windows
+HISTORY_PAGE_SIZE = 100
+HISTORY_FETCH_WINDOWS = 8
+
 def extract_thread_id_from_url(url):
     """Extracts the thread ID from a Discord URL."""
-    match = re.search(r'/(\d+)$', url)
-    if match:
-        return int(match.group(1))
+    _, sep, tail = url.rpartition('/')
+    if sep and tail.isdecimal():
+        return int(tail)
     else:
-        print(f"ERROR: Failed to extract thread ID from URL: {url}. Regex did not match.", file=sys.stderr, flush=True)
+        log.error("Failed to extract thread ID from URL: %s. URL does not end in a numeric ID.", url)
         return None
 
-async def get_thread_messages(thread_id, client):
-    """Fetches messages from a specific Discord thread."""
-    try:
-        thread = client.get_channel(thread_id)
-        if not thread:
-            print(f"LOG: Attempting to fetch thread {thread_id} using client.fetch_channel...", file=sys.stderr, flush=True)
-            thread = await client.fetch_channel(thread_id)
-        
-        if not thread:
-            print(f"ERROR: Could not find thread with ID {thread_id}. Ensure bot is in the server and the ID is correct.", file=sys.stderr, flush=True)
-            return []
-
-        print(f"LOG: Successfully found thread '{thread.name}'. Starting message history fetch.", file=sys.stderr, flush=True)
-        messages = []
+def forget_thread(thread_id):
+    """Drops a cached thread lookup, e.g. after the thread was deleted."""
+    _THREAD_CACHE.pop(thread_id, None)
+
+async def resolve_thread(thread_id, client):
+    """Returns the thread object, caching fetch_channel results for THREAD_CACHE_TTL_SECONDS."""
+    thread = client.get_channel(thread_id)
+    if thread:
+        return thread
+
+    cached = _THREAD_CACHE.get(thread_id)
+    if cached:
+        if time.monotonic() - cached[0] < THREAD_CACHE_TTL_SECONDS:
+            return cached[1]
+        forget_thread(thread_id)
+
+    log.info("Attempting to fetch thread %s using client.fetch_channel...", thread_id)
+    thread = await client.fetch_channel(thread_id)
+    if thread:
+        _THREAD_CACHE[thread_id] = (time.monotonic(), thread)
+    return thread
+
+def _log_history_error(thread_id, e):
+    """Logs a failed thread history fetch with a hint matching the error type."""
+    if isinstance(e, discord.errors.Forbidden):
+        log.error("Permission denied to access thread %s. Check bot's roles/permissions. Details: %s", thread_id, e)
+    elif isinstance(e, discord.errors.NotFound):
+        log.error("Thread %s not found on Discord. Details: %s", thread_id, e)
+    else:
+        log.error("Unexpected error fetching messages from thread %s. Details: %s", thread_id, e)
+
+def _history_windows(thread):
+    """Splits the thread's lifetime into (after_id, before_id) snowflake windows, newest first.
+
+    Returns None when the thread fits in one history page (or its size is unknown), since a
+    single stream is cheaper there. The newest window has no before bound.
+    """
+    message_count = getattr(thread, 'message_count', None) or 0
+    windows = min(HISTORY_FETCH_WINDOWS, -(-message_count // HISTORY_PAGE_SIZE))
+    if windows < 2:
+        return None
+
+    # Nothing in a thread is older than the thread itself (a forum starter message shares its id)
+    oldest = thread.id - 1
+    newest = discord.utils.time_snowflake(discord.utils.utcnow())
+    step = (newest - oldest) // windows
+    bounds = [oldest + i * step for i in range(windows)]
+    # after/before are exclusive, so window i covers ids in (bounds[i], bounds[i + 1]]
+    return [
+        (bounds[i], bounds[i + 1] + 1 if i + 1 < windows else None)
+        for i in reversed(range(windows))
+    ]
+
+async def _fetch_history_window(thread, after_id, before_id):
+    """Returns the thread messages with after_id < id < before_id, newest first."""
+    return [
+        message async for message in thread.history(
+            limit=None,
+            after=discord.Object(id=after_id),
+            before=discord.Object(id=before_id) if before_id else None,
+            oldest_first=False,
+        )
+    ]
+
+async def iter_thread_messages(thread_id, client):
+    """Yields messages from a specific Discord thread, newest first, as history pages arrive. Fetch errors propagate."""
+    thread = await resolve_thread(thread_id, client)
+    
+    if not thread:
+        log.error("Could not find thread with ID %s. Ensure bot is in the server and the ID is correct.", thread_id)
+        return
+
+    log.info("Successfully found thread '%s'. Starting message history fetch.", thread.name)
+    windows = _history_windows(thread)
+    if windows is None:
         async for message in thread.history(limit=None):
-            messages.append(message)
-        print(f"LOG: Successfully fetched {len(messages)} messages.", file=sys.stderr, flush=True)
-        return messages
-    except discord.errors.Forbidden as e:
-        print(f"ERROR: Permission denied to access thread {thread_id}. Check bot's roles/permissions. Details: {e}", file=sys.stderr, flush=True)
-        return []
-    except discord.errors.NotFound as e:
-        print(f"ERROR: Thread {thread_id} not found on Discord. Details: {e}", file=sys.stderr, flush=True)
-        return []
-    except Exception as e:
-        print(f"ERROR: Unexpected error fetching messages from thread {thread_id}. Details: {e}", file=sys.stderr, flush=True)
-        return []
+            yield message
+        return
+
+    # Page through every window at once; yielding them newest first keeps the usual history order
+    log.info("Fetching thread %s history in %d concurrent windows.", thread_id, len(windows))
+    tasks = [asyncio.create_task(_fetch_history_window(thread, after_id, before_id)) for after_id, before_id in windows]
+    try:
+        for task in tasks:
+            for message in await task:
+                yield message
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Retrieve every outcome so a failed window doesn't also log "exception was never retrieved"
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def iter_image_messages(thread_id, client):
+    """Yields (message, image_urls) for a thread's image posts as history pages arrive. Fetch errors propagate."""
+    async for message in iter_thread_messages(thread_id, client):
+        if image_urls := get_image_urls(message):
+            yield message, image_urls
+
+async def collect_thread_posts(thread_id, client):
+    """Fetches a thread's image posts while processing each one as its history page arrives.
 
-def filter_image_posts(messages):
-    """Filters messages to include only those with images."""
+    Returns (image_posts, processed_data); image_posts is None if the history could not be fetched.
+    Non-image messages are dropped as they stream past instead of being kept for a second pass.
+    """
     image_posts = []
-    for message in messages:
-        if message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    image_posts.append(message)
-                    break
-    return image_posts
-
-async def get_post_data(message):
-    """Extracts data from a message, excluding author's own reactions."""
+    tasks = []
+    link_prefix = None
+    try:
+        async for message, image_urls in iter_image_messages(thread_id, client):
+            image_posts.append((message, image_urls))
+            if link_prefix is None:
+                link_prefix = post_link_prefix(message)
+            # Reaction fetches for this post overlap with the remaining history pagination
+            tasks.append(asyncio.create_task(get_post_data(message, image_urls, link_prefix)))
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        if isinstance(e, discord.errors.NotFound):
+            forget_thread(thread_id)
+        _log_history_error(thread_id, e)
+        return None, []
+    log.info("Found %d image posts in thread %s.", len(image_posts), thread_id)
+    return image_posts, await asyncio.gather(*tasks)
+
+def get_image_urls(message):
+    """Returns the URLs of the message's image attachments (empty if it has none)."""
+    return [
+        attachment.url for attachment in message.attachments
+        if (content_type := attachment.content_type) and content_type.startswith('image/')
+    ]
+
+async def get_reaction_user_ids(reaction):
+    """Fetches the ids of all users for a reaction, bounded by the shared API semaphore."""
+    async with DISCORD_API_SEMAPHORE:
+        return {user.id async for user in reaction.users()}
+
+def post_link_prefix(message):
+    """Returns the https://discord.com/channels/<guild>/<channel> part shared by every post link in a thread."""
     guild_id = message.guild.id if message.guild else "unknown_guild"
-    post_link = f"https://discord.com/channels/{guild_id}/{message.channel.id}/{message.id}"
-    image_links = [att.url for att in message.attachments if att.content_type and att.content_type.startswith('image/')]
+    return f"https://discord.com/channels/{guild_id}/{message.channel.id}"
+
+async def get_post_data(message, image_links, link_prefix=None):
+    """Extracts data from a message, excluding author's own reactions. image_links come from get_image_urls.
+
+    Callers processing a whole thread pass link_prefix from post_link_prefix once instead of per message.
+    """
+    if link_prefix is None:
+        link_prefix = post_link_prefix(message)
+    post_link = f"{link_prefix}/{message.id}"
 
     total_reactions = 0
-    individual_reaction_counts = {}
+    individual_reaction_counts = Counter()
+    reactor_ids = set()
     author_id = message.author.id
 
-    for reaction in message.reactions:
-        try:
-            async for user in reaction.users():
-                if user.id != author_id:
-                    total_reactions += 1
-                    emoji_str = str(reaction.emoji)
-                    individual_reaction_counts[emoji_str] = individual_reaction_counts.get(emoji_str, 0) + 1
-        except Exception as e:
-            print(f"WARNING: Failed to fetch users for reaction {reaction.emoji} on message {message.id}. Details: {e}", file=sys.stderr, flush=True)
+    # Fetch every reaction's users concurrently; a failed fetch only skips that reaction
+    results = await asyncio.gather(
+        *(get_reaction_user_ids(reaction) for reaction in message.reactions), return_exceptions=True
+    )
+
+    for reaction, user_ids in zip(message.reactions, results):
+        if isinstance(user_ids, Exception):
+            log.warning("Failed to fetch users for reaction %s on message %s. Details: %s", reaction.emoji, message.id, user_ids)
             continue # Continue to the next reaction
 
-    individual_reactions = [{"emoji": emoji, "count": count} for emoji, count in individual_reaction_counts.items()]
-    sorted_individual_reactions = sorted(individual_reactions, key=lambda x: x["count"], reverse=True)
+        # Exclude the author's own reaction
+        user_ids.discard(author_id)
+        if not user_ids:
+            continue
+        total_reactions += len(user_ids)
+        reactor_ids |= user_ids
+        individual_reaction_counts[str(reaction.emoji)] += len(user_ids)
+
+    sorted_individual_reactions = [
+        {"emoji": emoji, "count": count} for emoji, count in individual_reaction_counts.most_common()
+    ]
+
+    return PostData(
+        post_link=post_link,
+        image_links=image_links,
+        posted_at=message.created_at,
+        author=message.author.display_name,
+        reactions=total_reactions,
+        individual_reactions=sorted_individual_reactions,
+        reactor_ids=reactor_ids,
+    )
+
+async def get_all_post_data(image_posts):
+    """Processes one thread's (message, image_urls) pairs concurrently, preserving message order in the result."""
+    # Concurrency is bounded where the HTTP calls happen (get_reaction_user_ids); holding
+    # DISCORD_API_SEMAPHORE here as well would let waiting posts starve their own reaction fetches.
+    if not image_posts:
+        return []
+    # All pairs come from one thread, so the guild/channel part of the post link is shared
+    link_prefix = post_link_prefix(image_posts[0][0])
+    tasks = [asyncio.create_task(get_post_data(message, image_urls, link_prefix)) for message, image_urls in image_posts]
+    return await asyncio.gather(*tasks)
 
-    return {
-        "post_link": post_link,
-        "image_links": ", ".join(image_links),
-        "posted_at": message.created_at.isoformat(),
-        "author": message.author.display_name,
-        "reactions": total_reactions,
-        "individual_reactions": sorted_individual_reactions
-    }
+CSV_FIELDNAMES = ("post_link", "image_links", "posted_at", "author", "reactions")
+# The header never needs quoting, so it is prebuilt with csv's default \r\n terminator
+CSV_HEADER_LINE = ",".join(CSV_FIELDNAMES) + "\r\n"
 
 def generate_csv(data, filename):
-    """Generates a CSV file from the extracted post data."""
+    """Generates an in-memory CSV attachment from the extracted post data."""
     if not data:
-        print(f"WARNING: No data to write to {filename}. Skipping CSV generation.", file=sys.stderr, flush=True)
+        log.warning("No data to write to %s. Skipping CSV generation.", filename)
         return None
 
-    fieldnames = ["post_link", "image_links", "posted_at", "author", "reactions"]
-    csv_data = []
-    for item in data:
-        temp_item = item.copy()
-        temp_item.pop('individual_reactions', None)
-        csv_data.append(temp_item)
+    # Build the CSV in memory
+    buffer = io.StringIO(newline='')
+    buffer.write(CSV_HEADER_LINE)
+    writer = csv.writer(buffer)
+    writer.writerows(
+        (item.post_link, ", ".join(item.image_links), item.posted_at.isoformat(), item.author, item.reactions)
+        for item in data
+    )
+    csv_bytes = io.BytesIO(buffer.getvalue().encode('utf-8'))
+    log.info("CSV data generated in memory for %s (%d bytes).", filename, csv_bytes.getbuffer().nbytes)
+    return discord.File(csv_bytes, filename=filename)
 
-    try:
-        # Use /tmp for writable storage in Cloud Run
-        filepath = f"/tmp/{filename}"
-        with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(csv_data)
-        print(f"LOG: Data successfully written to temporary CSV file: {filepath}", file=sys.stderr, flush=True)
-        return filepath
-    except IOError as e:
-        print(f"ERROR: Failed to write CSV file to {filepath}. Check /tmp directory permissions (should be fine in GCR). Details: {e}", file=sys.stderr, flush=True)
-        return None
+# Long synchronous loops yield to the event loop after this many iterations
+YIELD_EVERY = 256
 
-def generate_markdown_output(data, num_top_posts, total_image_posts_count,
-                             total_thread_reactions, total_unique_reactors_count,
-                             include_image_links):
-    """Generates Discord-formatted Markdown for the top posts."""
-    markdown = "🏆 **Photo Challenge Results** 🏆\n\n"
-    markdown += f"📊 **Summary:**\n"
-    markdown += f"• Total photos: `{total_image_posts_count}`\n"
-    markdown += f"• Total votes (excluding authors): `{total_thread_reactions}`\n"
-    markdown += f"• Unique voters: `{total_unique_reactors_count}`\n\n"
-    
-    if not data or all(d['reactions'] == 0 for d in data):
-        markdown += "📷 No posts found with external votes to display."
-        return markdown
-    
-    markdown += f"🥇 **Top {min(num_top_posts, len([d for d in data if d['reactions'] > 0]))} Image Posts:**\n\n"
-
-    sorted_data = sorted(data, key=lambda x: x["reactions"], reverse=True)
-    grouped_posts = {}
-    for post in sorted_data:
-        reactions = post['reactions']
-        if reactions > 0:  # Only show posts with votes
-            if reactions not in grouped_posts:
-                grouped_posts[reactions] = []
-            grouped_posts[reactions].append(post)
-
-    if not grouped_posts:
-        markdown += "No posts found with external votes to display."
-        return markdown
-
-    sorted_groups = sorted(grouped_posts.keys(), reverse=True)
-
-    current_rank = 1
-    output_lines = []
-
-    for reactions in sorted_groups:
-        if current_rank > num_top_posts:
-            break
-
-        posts_in_group = grouped_posts[reactions]
-        
-        # Determine rank emoji
-        rank_emoji = "🥇" if current_rank == 1 else "🥈" if current_rank == 2 else "🥉" if current_rank == 3 else f"{current_rank}️⃣"
-        
-        # Start a new rank entry
-        group_lines = []
-        
-        # Conditionally include vote count for detailed version
-        vote_info = f" (`{reactions}` votes)" if include_image_links else ""
-        group_lines.append(f"{rank_emoji} **Rank {current_rank}**{vote_info}")
-        
-        for post in posts_in_group:
-            # Post link and author
-            group_lines.append(f"   📸 **[{post['author']}]({post['post_link']})**")
-            
-            # Conditionally include image links (Full version)
-            if include_image_links:
-                image_link = post['image_links'].split(', ')[0]
-                if image_link:
-                    group_lines.append(f"      🔗 [View Image]({image_link})")
-            
-            # Conditionally include individual reactions (Full version)
-            if include_image_links:
-                reactions_str = ""
-                if post['individual_reactions']:
-                    reactions_emojis = [r['emoji'] for r in post['individual_reactions']]
-                    reactions_str = " " + " ".join(reactions_emojis)
-                
-                group_lines.append(f"      ⭐ {post['reactions']} votes{reactions_str}")
-
-        output_lines.extend(group_lines)
-        output_lines.append("")  # Add spacing between ranks
-        current_rank += 1
-        
-    return markdown + "\n".join(output_lines).rstrip()
+# Medal emoji for the first three ranks, keycap digits for the next two; one per ranked group
+RANK_EMOJI = ("🥇", "🥈", "🥉", "4️⃣", "5️⃣")
+
+async def prepare_ranking(data):
+    """Returns the top (reactions, posts) groups of voted posts, highest first, one per RANK_EMOJI entry."""
+    # Group voted posts by vote count, then take the highest counts
+    grouped_posts = defaultdict(list)
+    for i, post in enumerate(data, 1):
+        if i % YIELD_EVERY == 0:
+            await asyncio.sleep(0)  # Let heartbeats and other handlers run on very large threads
+        if post.reactions > 0:
+            grouped_posts[post.reactions].append(post)
+    return [(reactions, grouped_posts[reactions]) for reactions in heapq.nlargest(len(RANK_EMOJI), grouped_posts)]
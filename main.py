@@ -1,16 +1,22 @@
 import discord
 from discord.ext import commands
+import logging
 import os
 import sys
 import asyncio
-import threading
-import time
 
-# Import Flask for the required HTTP health check listener
-from flask import Flask
+# aiohttp (already a discord.py dependency) serves the HTTP health check on the bot's event loop
+from aiohttp import web
+
+# uvloop is an optional faster event loop; fall back to asyncio's default loop where it isn't installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Import the command setup function
-from commands import setup_commands
+from commands import setup_commands, invalidate_thread_cache
+from core_logic import forget_thread
 
 # --- Configuration using Environment Variables (Injected by Cloud Run) ---
 DISCORD_BOT_TOKEN = os.environ.get('DISCORD_BOT_TOKEN')
@@ -18,25 +24,30 @@ DISCORD_CLIENT_ID = os.environ.get('DISCORD_CLIENT_ID')
 DISCORD_THREAD_URL = os.environ.get('DISCORD_THREAD_URL')
 PORT = int(os.environ.get('PORT', 8080))
 
+# Configure logging once for the whole process; modules log through logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+
 # --- Global Bot State ---
 bot = None
-bot_thread = None
-
-# Create Flask app first - this MUST happen immediately
-app = Flask(__name__)
-
-print(f"LOG: Flask app created and ready to serve on port {PORT}", file=sys.stderr, flush=True)
+bot_task = None
 
 # --- Simple Routes First ---
-@app.route('/', methods=['GET'])
-def health_check():
+routes = web.RouteTableDef()
+
+@routes.get('/')
+async def health_check(request):
     """Health check route for Cloud Run."""
-    return "Flask server is running. Discord bot status: " + ("Running" if bot_thread and bot_thread.is_alive() else "Starting"), 200
+    bot_status = "Running" if bot_task and not bot_task.done() else "Starting"
+    return web.Response(text="Web server is running. Discord bot status: " + bot_status)
 
-@app.route('/health', methods=['GET'])
-def simple_health():
+@routes.get('/health')
+async def simple_health(request):
     """Simple health check that always returns 200."""
-    return "OK", 200
+    return web.Response(text="OK")
+
+app = web.Application()
+app.add_routes(routes)
 
 # --- Bot Setup ---
 class PhotoBot(commands.Bot):
@@ -48,40 +59,67 @@ class PhotoBot(commands.Bot):
         # Set up slash commands
         try:
             setup_commands(self)
-            print("LOG: Commands setup completed.", file=sys.stderr, flush=True)
+            log.info("Commands setup completed.")
         except Exception as e:
-            print(f"ERROR: Failed to setup commands: {e}", file=sys.stderr, flush=True)
+            log.error("Failed to setup commands: %s", e)
         
         # Sync the application commands (slash commands) with Discord
         if DISCORD_CLIENT_ID:
             try:
                 # Sync commands globally
                 synced = await self.tree.sync()
-                print(f"LOG: Slash commands synced successfully. {len(synced)} commands registered.", file=sys.stderr, flush=True)
+                log.info("Slash commands synced successfully. %d commands registered.", len(synced))
                 for cmd in synced:
-                    print(f"LOG: Registered command: {cmd.name}", file=sys.stderr, flush=True)
+                    log.info("Registered command: %s", cmd.name)
             except Exception as e:
-                print(f"ERROR: Failed to sync slash commands. Check bot permissions and application ID. Details: {e}", file=sys.stderr, flush=True)
+                log.error("Failed to sync slash commands. Check bot permissions and application ID. Details: %s", e)
 
     async def on_ready(self):
-        print(f'LOG: Bot is running. Logged in as {self.user} (ID: {self.user.id})', file=sys.stderr, flush=True)
-        print(f'LOG: Default Thread URL from ENV: {self.default_thread_url}', file=sys.stderr, flush=True)
+        log.info("Bot is running. Logged in as %s (ID: %s)", self.user, self.user.id)
+        log.info("Default Thread URL from ENV: %s", self.default_thread_url)
+
+    # Reactions and deletions don't move last_message_id, so drop the cached history explicitly
+    async def on_raw_reaction_add(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_reaction_remove(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_reaction_clear(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_reaction_clear_emoji(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_message_edit(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_message_delete(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        invalidate_thread_cache(payload.channel_id)
+
+    # A deleted thread must not be served from the fetch_channel or history caches
+    async def on_raw_thread_delete(self, payload):
+        forget_thread(payload.thread_id)
+        invalidate_thread_cache(payload.thread_id)
 
     async def on_error(self, event_method, *args, **kwargs):
         # Log Discord internal errors
-        print(f'ERROR: Ignoring exception in Discord event handler: {event_method}', file=sys.stderr, flush=True)
+        log.error("Ignoring exception in Discord event handler: %s", event_method)
 
     async def on_command_error(self, context, exception):
         if isinstance(exception, commands.CommandNotFound):
             return
         # Log command-specific errors
-        print(f"ERROR: Command execution failed. Command: {context.command}. Details: {exception}", file=sys.stderr, flush=True)
+        log.error("Command execution failed. Command: %s. Details: %s", context.command, exception)
 
 
-def run_bot_in_thread():
-    """Run the Discord bot in a separate thread with its own event loop."""
+async def run_bot():
+    """Run the Discord bot on the current event loop until it disconnects or fails."""
     try:
-        print("LOG: Starting Discord bot in background thread...", file=sys.stderr, flush=True)
+        log.info("Starting Discord bot...")
         
         # Create intents and bot
         intents = discord.Intents.default()
@@ -92,39 +130,38 @@ def run_bot_in_thread():
         global bot
         bot = PhotoBot(intents=intents)
         
-        # Create a new event loop for this thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Run the bot
-        token = os.environ.get('DISCORD_BOT_TOKEN')
-        if not token:
-            print("CRITICAL ERROR: DISCORD_BOT_TOKEN environment variable is not set. Bot cannot connect.", file=sys.stderr, flush=True)
-            return
-            
-        print("LOG: Attempting to start Discord bot...", file=sys.stderr, flush=True)
-        loop.run_until_complete(bot.start(token))
+        # Run the bot (main() has already checked that the token is set)
+        log.info("Attempting to start Discord bot...")
+        async with bot:
+            await bot.start(DISCORD_BOT_TOKEN)
     except Exception as e:
-        print(f"CRITICAL ERROR: Discord bot thread failed: {e}", file=sys.stderr, flush=True)
-
-def start_bot_thread():
-    """Start the Discord bot in a background thread."""
-    global bot_thread
-    if bot_thread is None:
-        print("LOG: Creating Discord bot thread...", file=sys.stderr, flush=True)
-        bot_thread = threading.Thread(target=run_bot_in_thread, daemon=True)
-        bot_thread.start()
-        print("LOG: Discord bot thread started.", file=sys.stderr, flush=True)
-        # Give the thread a moment to start
-        time.sleep(0.1)
-
-# Start bot thread but don't wait for it
-print("LOG: Initializing Discord bot in background...", file=sys.stderr, flush=True)
-start_bot_thread()
-
-# This is required for Gunicorn to find the Flask app
-print("LOG: Flask app is ready for Gunicorn", file=sys.stderr, flush=True)
+        log.critical("Discord bot failed: %s", e)
+
+async def run_web_server():
+    """Serve the health check routes until the process is stopped."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host="0.0.0.0", port=PORT).start()
+        log.info("Web server listening on port %s", PORT)
+        # Keep serving even if the bot stops, so Cloud Run health checks still get an answer
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def main():
+    """Run the HTTP health check and the Discord bot together on one event loop."""
+    # Fail fast so Cloud Run reports the container as crashed
+    if not DISCORD_BOT_TOKEN:
+        log.critical("DISCORD_BOT_TOKEN environment variable is not set. Bot cannot connect.")
+        raise SystemExit(1)
+
+    global bot_task
+    bot_task = asyncio.create_task(run_bot())
+    await asyncio.gather(run_web_server(), bot_task)
 
 if __name__ == "__main__":
-    print("LOG: Running Flask app directly (development mode)", file=sys.stderr, flush=True)
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())